@@ -1,284 +1,866 @@
-import os
-import json
-import io
-import logging
-from datetime import datetime 
-
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS
-from dotenv import load_dotenv
-import google.generativeai as genai
-from PIL import Image
-from pdf2image import convert_from_bytes
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-load_dotenv()
-app = Flask(__name__, static_folder='.', static_url_path='')
-CORS(app)  # Enables CORS for all routes
-
-try:
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    logger.info("✅ Gemini API configured successfully.")
-except Exception as e:
-    logger.error(f"❌ Failed to configure Gemini API: {e}")
-
-SCHEMAS = {
-    "medical_report": {
-        "patient_name": "", "hospital_name": "",
-        "report_date": "", "report_type": "", "clinical_findings": ""
-    },
-    
-    "prescription": {
-        "patient_name": "", "doctor_name": "", "clinic_name": "",
-        "prescription_date": "",
-        "diagnosis_notes": ""
-    },
-    "medical_bill": {
-        "patient_name": "", "hospital_or_clinic_name": "",
-        "bill_date": "",
-        "bill_items": [], 
-        "total_amount": ""
-    }
-}
-
-def format_and_validate_date(date_string: str) -> str:
-    """
-    Attempts to parse a date string from various formats and returns it as 'dd/mm/yyyy'.
-    Returns an empty string if the date is invalid or cannot be parsed.
-    """
-    if not isinstance(date_string, str) or not date_string.strip():
-        return ""
-
-    # A list of common date formats to try
-    possible_formats = [
-        '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%m/%d/%Y',
-        '%d %b %Y', '%d %B %Y', '%Y/%m/%d', '%d-%b-%y',
-        '%m-%d-%Y', '%B %d, %Y',
-    ]
-
-    for fmt in possible_formats:
-        try:
-            date_obj = datetime.strptime(date_string, fmt)
-            return date_obj.strftime('%d/%m/%Y')
-        except ValueError:
-            continue  # If parsing fails, try the next format
-
-    logger.warning(f"Could not parse date: '{date_string}'. Returning empty string.")
-    return "" # Return empty if no format matches
-
-
-def convert_pdf_to_images(pdf_bytes):
-    """Converts a PDF file in bytes to a list of PIL Image objects."""
-    try:
-        logger.info("Starting PDF conversion...")
-        if not pdf_bytes:
-            raise ValueError("Empty PDF bytes received")
-
-        poppler_path = r"C:\poppler-24.08.0\Library\bin" # use your custom path
-        if not os.path.exists(poppler_path):
-            raise ValueError(f"Poppler not found at: {poppler_path}")
-            
-        logger.info(f"Using Poppler from: {poppler_path}")
-        
-        images = convert_from_bytes(
-            pdf_bytes,
-            poppler_path=poppler_path,
-            dpi=200
-        )
-        
-        if not images:
-            raise ValueError("PDF conversion produced no images")
-            
-        logger.info(f"Successfully converted PDF to {len(images)} images")
-        return images
-    except Exception as e:
-        logger.error(f"PDF conversion failed: {str(e)}", exc_info=True)
-        return []
-    
-
-def extract_data_with_gemini(image_list, doc_type):
-
-    if doc_type not in SCHEMAS:
-        raise ValueError("Invalid document type specified.")
-    
-    model = genai.GenerativeModel('gemini-2.5-flash-lite')
-    schema = SCHEMAS[doc_type]
-    prompt = f"""
-    Analyze the image of a '{doc_type}' and extract information into this exact JSON format.
-    Ensure all date fields are formatted as dd/mm/yyyy.
-    If a value is missing, not found, or ambiguous, return an empty string "" or an empty list [] as appropriate. Do not guess or fabricate information. Do not add explanations or markdown.
-    Schema: {json.dumps(schema)}
-    """
-    
-    extracted_pages = []
-    for i, image in enumerate(image_list):
-        logger.info(f"  > Processing page {i+1}/{len(image_list)} with Gemini...")
-        try:
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_bytes = img_byte_arr.getvalue()
-            
-            response = model.generate_content([prompt, {"mime_type": "image/png", "data": img_bytes}])
-            response.resolve()
-            
-            cleaned_text = response.text.strip().replace("```json", "").replace("```", "")
-            page_data = json.loads(cleaned_text)
-
-            # --- NEW: Post-processing to validate and format dates ---
-            date_fields_to_check = ["report_date", "prescription_date", "bill_date"]
-            for key, value in page_data.items():
-                if key in date_fields_to_check:
-                    page_data[key] = format_and_validate_date(value)
-            
-            extracted_pages.append(page_data)
-        except Exception as e:
-            logger.error(f"  > Gemini extraction failed for page {i+1}: {e}")
-            extracted_pages.append(schema) # Append blank schema on failure
-
-    return extracted_pages
-
-@app.route('/')
-def index():
-    return send_file('index_2.html')
-
-@app.route('/extract-documents', methods=['POST'])
-def extract_documents():
-    """
-    [MODIFIED] Stage 1: Extracts page-wise data and includes filenames in the response.
-    """
-    logger.info("Received request for document extraction.")
-    
-    results = {"medical_report": [], "prescription": [], "medical_bill": []}
-    doc_type_map = {
-        "medical_report_files": "medical_report",
-        "prescription_files": "prescription",
-        "medical_bill_files": "medical_bill"
-    }
-    
-    try:
-        for field_name, doc_type in doc_type_map.items():
-            uploaded_files = request.files.getlist(field_name)
-            if not uploaded_files: continue
-            
-            logger.info(f"Processing {len(uploaded_files)} file(s) for type: {doc_type}")
-            
-            for file in uploaded_files:
-                images = []
-                if file.filename.lower().endswith('.pdf'):
-                    images = convert_pdf_to_images(file.read())
-                elif file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    images = [Image.open(file.stream)]
-                else:
-                    logger.warning(f"Skipping unsupported file: {file.filename}")
-                    continue
-                
-                if images:
-                    # This now returns a list of page data
-                    page_wise_data = extract_data_with_gemini(images, doc_type)
-                    # We package it with the filename
-                    results[doc_type].append({
-                        "filename": file.filename,
-                        "pages": page_wise_data
-                    })
-
-        return jsonify(results), 200
-        
-    except Exception as e:
-        logger.error(f"An error occurred during extraction: {e}", exc_info=True)
-        return jsonify({"error": "An internal error occurred during document extraction."}), 500
-
-@app.route('/adjudicate-claim', methods=['POST'])
-def adjudicate_claim():
-    logger.info("Received request for claim adjudication.")
-    
-    extracted_data = request.get_json()
-    if not extracted_data:
-        return jsonify({"error": "No extracted data provided."}), 400
-
-    def summarize_category(category_data):
-        if not category_data: return {}
-        all_pages = category_data[0].get("pages", [])
-        summary = {}
-        for page in all_pages:
-            for key, value in page.items():
-                if value:
-                    summary[key] = value
-        return summary
-
-    report_summary = summarize_category(extracted_data.get("medical_report", []))
-    prescription_summary = summarize_category(extracted_data.get("prescription", []))
-    bill_summary = summarize_category(extracted_data.get("medical_bill", []))
-    
-    expected_output = {
-        "claimValidation": {
-            "isPatientNameConsistent": True,
-            "isConsistent": True,
-            "isTreatmentBillMatch": True,
-            "isDateSequenceLogical": True
-        },
-        "finalAssessment": {
-            "isClaimValid": True,
-            "confidenceScore":0.7,
-            "reasoning": [
-                "Example reasoning 1",
-                "Example reasoning 2",
-                "Example reasoning 3"
-            ]
-        }
-    }
-
-
-    adjudication_prompt = f"""
-    You are an expert insurance claim adjudicator. Analyze the following structured data from a patient's claim and determine if it is valid. Some fields may be empty, indicating missing or inapplicable information, you can ignore those.
-
-    **Clinical Report Data:**
-    {json.dumps(report_summary, indent=2)}
-
-    **Prescription Data:**
-    {json.dumps(prescription_summary, indent=2)}
-
-    **Billing Data:**
-    {json.dumps(bill_summary, indent=2)}
-
-Apply the following logic to generate your response.
-
-isPatientNameConsistent: Only fail if there are substantial differences indicating different individuals (different first names, last names, or clearly unrelated identifiers).
-
-isConsistent: Does the patient's diagnosis justify the prescribed medications?
-
-isTreatmentBillMatch: Do all billed items (procedures, tests, medications) directly match what is documented in the clinical and prescription reports?
-
-isDateSequenceLogical: Are all event dates in a logical chronological order (admission → treatment → discharge → billing)?
-
-reasing: Every check must be justified with specific data from the source. This applies to both PASS and FAIL outcomes.
-    Cite matching data points that confirm the check passed.
-    Cite conflicting data points that prove the check failed.
-
-    **Why this matters:** Explicit citations are mandatory to ensure conclusions are verifiable, prevent hallucinations, and support reliable human review.
-    **Output Format:**
-    {json.dumps(expected_output, indent=2)}
-    
-    Do not include any additional text or markdown formatting.
-    """
-    
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(adjudication_prompt)
-        response.resolve()
-        
-        cleaned_text = response.text.strip().replace("```json", "").replace("```", "")
-        adjudication_result = json.loads(cleaned_text)
-        
-        logger.info("Successfully adjudicated claim.")
-        return jsonify(adjudication_result), 200
-        
-    except Exception as e:
-        logger.error(f"An error occurred during adjudication: {e}", exc_info=True)
-        return jsonify({"error": "An internal error occurred during claim adjudication."}), 500
-
-# --- MAIN EXECUTION ---
-if __name__ == '__main__':
-
-    app.run(debug=True, port=5001)
+import os
+import io
+import re
+import time
+import hashlib
+import base64
+import logging
+import tempfile
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+from flask import Flask, request, jsonify, send_file
+from flask.json.provider import JSONProvider
+from flask_cors import CORS
+from dotenv import load_dotenv
+import google.generativeai as genai
+import orjson
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from PIL import Image
+import pypdfium2 as pdfium
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify/request.get_json use
+    its SIMD-accelerated parser instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Flask(__name__, static_folder='.', static_url_path='')
+app.json = OrjsonProvider(app)
+CORS(app)  # Enables CORS for all routes
+
+try:
+    # REST rides on requests/urllib3, so connections are pooled via
+    # keep-alive and — unlike gRPC's C core, which bypasses Python sockets —
+    # the calls actually yield under gevent's monkey-patching in the
+    # gunicorn deployment documented in wsgi.py.
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"), transport='rest')
+    logger.info("✅ Gemini API configured successfully.")
+except Exception as e:
+    logger.error(f"❌ Failed to configure Gemini API: {e}")
+
+EXTRACT_MODEL_NAME = 'gemini-2.5-flash-lite'
+ADJUDICATE_MODEL_NAME = 'gemini-2.5-flash'
+
+SCHEMAS = {
+    "medical_report": {
+        "patient_name": "", "hospital_name": "",
+        "report_date": "", "report_type": "", "clinical_findings": ""
+    },
+    
+    "prescription": {
+        "patient_name": "", "doctor_name": "", "clinic_name": "",
+        "prescription_date": "",
+        "diagnosis_notes": ""
+    },
+    "medical_bill": {
+        "patient_name": "", "hospital_or_clinic_name": "",
+        "bill_date": "",
+        "bill_items": [],
+        "total_amount": ""
+    }
+}
+
+EXPECTED_OUTPUT = {
+    "claimValidation": {
+        "isPatientNameConsistent": True,
+        "isConsistent": True,
+        "isTreatmentBillMatch": True,
+        "isDateSequenceLogical": True
+    },
+    "finalAssessment": {
+        "isClaimValid": True,
+        "confidenceScore":0.7,
+        "reasoning": [
+            "Example reasoning 1",
+            "Example reasoning 2",
+            "Example reasoning 3"
+        ]
+    }
+}
+
+# Static rules/schema block for adjudication. Kept separate from the per-claim
+# patient data so the prefix stays byte-identical across requests and can live
+# in a Gemini context cache.
+ADJUDICATION_INSTRUCTION = f"""
+    You are an expert insurance claim adjudicator. Analyze the structured data from a patient's claim and determine if it is valid. Some fields may be empty, indicating missing or inapplicable information, you can ignore those.
+
+Apply the following logic to generate your response.
+
+isPatientNameConsistent: Only fail if there are substantial differences indicating different individuals (different first names, last names, or clearly unrelated identifiers).
+
+isConsistent: Does the patient's diagnosis justify the prescribed medications?
+
+isTreatmentBillMatch: Do all billed items (procedures, tests, medications) directly match what is documented in the clinical and prescription reports?
+
+isDateSequenceLogical: Are all event dates in a logical chronological order (admission → treatment → discharge → billing)?
+
+reasing: Every check must be justified with specific data from the source. This applies to both PASS and FAIL outcomes.
+    Cite matching data points that confirm the check passed.
+    Cite conflicting data points that prove the check failed.
+
+    **Why this matters:** Explicit citations are mandatory to ensure conclusions are verifiable, prevent hallucinations, and support reliable human review.
+    **Output Format:**
+    {orjson.dumps(EXPECTED_OUTPUT, option=orjson.OPT_INDENT_2).decode()}
+
+    Do not include any additional text or markdown formatting.
+    """
+
+# --- Gemini context caching -------------------------------------------------
+# The extraction schema prompt and the adjudication rules block are static and
+# re-sent on every call. Explicit context caching stores them server-side once
+# per TTL window, so cached prefix tokens are billed at a ~90% discount and
+# skip re-encoding on each request.
+CACHE_TTL_SECONDS = 3600
+
+# The API rejects caches whose prefix is below a model-dependent minimum
+# (1024+ tokens on the Flash family). Prompts under the threshold — which
+# includes the current extraction prompts — skip the doomed create call and
+# use a plain memoized model until they grow past it.
+MIN_CACHEABLE_TOKENS = 1024
+
+_cached_models = {}  # cache key -> {"model": ..., "expires": epoch seconds}
+_cached_models_lock = threading.Lock()
+
+
+def get_cached_model(cache_key, model_name, system_instruction):
+    """
+    Returns a GenerativeModel whose static system instruction is held in a
+    Gemini explicit context cache, recreating the cache when its TTL lapses.
+    Falls back to a plain model with the same instruction when caching is
+    unavailable (e.g. the prefix is below the minimum cacheable token count).
+    """
+    now = time.time()
+    with _cached_models_lock:
+        entry = _cached_models.get(cache_key)
+        if entry and now < entry["expires"]:
+            return entry["model"]
+
+    # Rough 4-chars-per-token estimate: too-small prefixes would be rejected
+    # server-side, so don't pay a create round-trip per TTL window for them.
+    if len(system_instruction) // 4 < MIN_CACHEABLE_TOKENS:
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    else:
+        try:
+            cached_content = genai.caching.CachedContent.create(
+                model=model_name,
+                system_instruction=system_instruction,
+                ttl=CACHE_TTL_SECONDS,
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+            logger.info(f"Created context cache '{cached_content.name}' for {cache_key}.")
+        except Exception as e:
+            logger.warning(f"Context caching unavailable for {cache_key} ({e}); using uncached model.")
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+
+    with _cached_models_lock:
+        # Refresh a minute before the server-side TTL actually expires.
+        _cached_models[cache_key] = {"model": model, "expires": now + CACHE_TTL_SECONDS - 60}
+    return model
+
+
+# Gemini preprocesses images down to a small internal resolution (Flash tiles
+# at <=768 px), so lossless multi-MB PNGs are wasted bandwidth and encode
+# time. Pages are rendered at 150 DPI and uploaded as JPEG; anything larger
+# than 1600 px on the long side — e.g. a 300 DPI A3 scan — is downscaled
+# first, which is loss-free for OCR-quality extraction since the model
+# resizes anyway.
+RENDER_DPI = 150
+GEMINI_IMAGE_MAX_SIDE = 1600
+GEMINI_JPEG_QUALITY = 80
+GEMINI_IMAGE_MIME = "image/jpeg"
+
+
+def encode_image_for_gemini(image):
+    """Encodes a page image as JPEG bytes sized for Gemini upload."""
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if max(image.size) > GEMINI_IMAGE_MAX_SIDE:
+        image.thumbnail((GEMINI_IMAGE_MAX_SIDE, GEMINI_IMAGE_MAX_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=GEMINI_JPEG_QUALITY, optimize=False)
+    return buf.getvalue()
+
+
+# Exact-match result cache: sha256 of the encoded page bytes + doc_type maps
+# to the parsed page data. Re-uploading the same document (retries, UI
+# debugging) then returns instantly instead of re-running the Gemini call.
+# Bounded with LRU eviction so a long-running worker can't accumulate every
+# page it has ever processed.
+EXTRACTION_CACHE_MAX_ENTRIES = 1024
+_extraction_cache = OrderedDict()
+_extraction_cache_lock = threading.Lock()
+
+
+# The schema JSON and extraction prompts are pure constants, so build them
+# once at import time instead of re-serializing inside the per-page hot path.
+SCHEMA_JSON = {doc_type: orjson.dumps(schema).decode() for doc_type, schema in SCHEMAS.items()}
+
+EXTRACTION_PROMPTS = {
+    doc_type: f"""
+    Analyze the image of a '{doc_type}' and extract information into this exact JSON format.
+    Ensure all date fields are formatted as dd/mm/yyyy.
+    If a value is missing, not found, or ambiguous, return an empty string "" or an empty list [] as appropriate. Do not guess or fabricate information. Do not add explanations or markdown.
+    Schema: {SCHEMA_JSON[doc_type]}
+    """
+    for doc_type in SCHEMAS
+}
+
+DATE_FIELDS = frozenset(("report_date", "prescription_date", "bill_date"))
+
+# Forces strict JSON output from Gemini — no markdown fences, no prose — so
+# responses parse directly without fence stripping. The schema dicts above are
+# examples rather than typed schemas (bill_items entries are free-form), so
+# only the mime type is constrained here.
+JSON_GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json")
+
+# --- Rate limiting and retry for Gemini calls -------------------------------
+# Fanning pages out across threads runs straight into Gemini's per-minute
+# request limits; without a limiter the 429s surface as page-level failures
+# that silently return the blank schema. All synchronous generate_content
+# calls go through a token bucket sized to GEMINI_RPM, with exponential
+# backoff on the 429s that still slip through.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+
+
+class _TokenBucket:
+    """Token-bucket limiter refilled continuously at `rpm` requests/minute."""
+
+    def __init__(self, rpm):
+        self.capacity = max(1, rpm)
+        self.fill_rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then consumes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+
+_gemini_rate_limiter = _TokenBucket(GEMINI_RPM)
+
+
+@retry(stop=stop_after_attempt(5), wait=wait_exponential_jitter(1, 30),
+       retry=retry_if_exception_type(ResourceExhausted), reraise=True)
+def generate_with_backoff(model, *args, **kwargs):
+    """Runs model.generate_content behind the shared rate limiter, retrying
+    429s with jittered exponential backoff instead of dropping the page."""
+    _gemini_rate_limiter.acquire()
+    try:
+        return model.generate_content(*args, **kwargs)
+    except ResourceExhausted:
+        # Logged apart from hard failures so throttling is visible even though
+        # callers fall back to the blank schema on giving up.
+        logger.warning("Gemini rate limit hit (429); backing off before retry.")
+        raise
+
+
+# Strips a leading/trailing markdown code fence in one pass. Anchored at the
+# ends of the string so a ``` inside a JSON string value is left alone, which
+# the old chained str.replace calls would have mangled.
+FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+
+# Precompiled shape classifiers so the common date forms dispatch to a single
+# parse instead of exception-driven trial of up to 10 strptime formats.
+_NUMERIC_DMY_RE = re.compile(r'^(\d{1,2})([/-])(\d{1,2})\2(\d{4})$')
+_NUMERIC_YMD_RE = re.compile(r'^(\d{4})([/-])(\d{1,2})\2(\d{1,2})$')
+_DAY_MONTHNAME_RE = re.compile(r'^\d{1,2} [A-Za-z]+ \d{4}$')
+_DAY_MONTHNAME_SHORT_RE = re.compile(r'^\d{1,2}-[A-Za-z]{3}-\d{2}$')
+_MONTHNAME_DAY_RE = re.compile(r'^[A-Za-z]+ \d{1,2}, \d{4}$')
+
+# A list of common date formats to try on shapes the regexes don't recognize
+POSSIBLE_FORMATS = [
+    '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%m/%d/%Y',
+    '%d %b %Y', '%d %B %Y', '%Y/%m/%d', '%d-%b-%y',
+    '%m-%d-%Y', '%B %d, %Y',
+]
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(date_string):
+    """Parses a date string to 'dd/mm/yyyy', or '' if it can't be parsed.
+
+    Results are cached since the same date strings recur within a batch."""
+    m = _NUMERIC_DMY_RE.match(date_string)
+    if m:
+        day, month, year = int(m.group(1)), int(m.group(3)), int(m.group(4))
+        # Day-first wins, matching the old format-chain order; fall back to
+        # month-first for unambiguous US-style dates like 04/25/2024.
+        for d, mo in ((day, month), (month, day)):
+            try:
+                return datetime(year, mo, d).strftime('%d/%m/%Y')
+            except ValueError:
+                continue
+        return ""
+
+    m = _NUMERIC_YMD_RE.match(date_string)
+    if m:
+        try:
+            return datetime(int(m.group(1)), int(m.group(3)), int(m.group(4))).strftime('%d/%m/%Y')
+        except ValueError:
+            return ""
+
+    if _DAY_MONTHNAME_RE.match(date_string):
+        formats = ('%d %b %Y', '%d %B %Y')
+    elif _DAY_MONTHNAME_SHORT_RE.match(date_string):
+        formats = ('%d-%b-%y',)
+    elif _MONTHNAME_DAY_RE.match(date_string):
+        formats = ('%B %d, %Y',)
+    else:
+        formats = POSSIBLE_FORMATS  # Exotic shapes: fall back to the full chain
+
+    for fmt in formats:
+        try:
+            return datetime.strptime(date_string, fmt).strftime('%d/%m/%Y')
+        except ValueError:
+            continue
+    return ""
+
+
+def format_and_validate_date(date_string: str) -> str:
+    """
+    Attempts to parse a date string from various formats and returns it as 'dd/mm/yyyy'.
+    Returns an empty string if the date is invalid or cannot be parsed.
+    """
+    if not isinstance(date_string, str) or not date_string.strip():
+        return ""
+
+    result = _parse_date(date_string)
+    if not result:
+        logger.warning(f"Could not parse date: '{date_string}'. Returning empty string.")
+    return result
+
+
+def _render_pdf_pages(pdf_bytes, page_indices, scale):
+    """Renders a contiguous chunk of pages from its own PdfDocument.
+
+    Module-level so ProcessPoolExecutor can pickle it; each worker process
+    opens the document itself since PDFium handles aren't shareable."""
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        return [pdf[i].render(scale=scale).to_pil() for i in page_indices]
+    finally:
+        pdf.close()
+
+
+def convert_pdf_to_images(pdf_source):
+    """Converts a PDF — raw bytes or a seekable binary stream — to a list of
+    PIL Image objects."""
+    try:
+        logger.info("Starting PDF conversion...")
+        if isinstance(pdf_source, bytes) and not pdf_source:
+            raise ValueError("Empty PDF bytes received")
+
+        # pypdfium2 renders in-process straight into PIL buffers — no Poppler
+        # subprocess, no PPM temp files, no platform-specific binary path.
+        # It reads file-like objects directly, so Werkzeug's spooled upload
+        # streams never need to be buffered into memory first.
+        pdf = pdfium.PdfDocument(pdf_source)
+        try:
+            n_pages = len(pdf)
+            # 150 DPI is comfortably above OCR quality and renders ~45% fewer
+            # pixels than the old 200 DPI setting.
+            scale = RENDER_DPI / 72
+            if n_pages > 8:
+                # Rasterization is CPU-bound and PDFium is not thread-safe, so
+                # big documents are split into contiguous page chunks rendered
+                # by a process pool, each worker on its own document instance
+                # (needs a bytes source, so streams are drained here only).
+                # Worker count is capped so several concurrent high-DPI
+                # renders can't exhaust memory.
+                if not isinstance(pdf_source, bytes):
+                    pdf_source.seek(0)
+                    pdf_source = pdf_source.read()
+                n_workers = min(os.cpu_count() or 1, 4)
+                chunk_size = -(-n_pages // n_workers)  # Ceiling division
+                chunks = [
+                    range(start, min(start + chunk_size, n_pages))
+                    for start in range(0, n_pages, chunk_size)
+                ]
+                with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+                    futures = [
+                        pool.submit(_render_pdf_pages, pdf_source, chunk, scale)
+                        for chunk in chunks
+                    ]
+                    images = [image for f in futures for image in f.result()]
+            else:
+                images = [pdf[i].render(scale=scale).to_pil() for i in range(n_pages)]
+        finally:
+            pdf.close()
+
+        if not images:
+            raise ValueError("PDF conversion produced no images")
+
+        logger.info(f"Successfully converted PDF to {len(images)} images")
+        return images
+    except Exception as e:
+        logger.error(f"PDF conversion failed: {str(e)}", exc_info=True)
+        return []
+
+
+
+def extract_data_with_gemini(image_list, doc_type):
+
+    if doc_type not in SCHEMAS:
+        raise ValueError("Invalid document type specified.")
+
+    if not image_list:
+        return []
+
+
+    schema = SCHEMAS[doc_type]
+    # The schema prompt rides along as a cached system instruction, so each
+    # call only uploads the page image itself.
+    model = get_cached_model(
+        f"extract:{doc_type}", EXTRACT_MODEL_NAME, EXTRACTION_PROMPTS[doc_type]
+    )
+    
+    def _process_page(indexed_future):
+        i, encode_future = indexed_future
+        logger.info(f"  > Processing page {i+1}/{len(image_list)} with Gemini...")
+        try:
+            img_bytes = encode_future.result()
+
+            cache_key = hashlib.sha256(img_bytes).hexdigest() + ':' + doc_type
+            with _extraction_cache_lock:
+                cached = _extraction_cache.get(cache_key)
+                if cached is not None:
+                    _extraction_cache.move_to_end(cache_key)
+            if cached is not None:
+                logger.info(f"  > Cache hit for page {i+1}, skipping Gemini call.")
+                return dict(cached)
+
+            response = generate_with_backoff(
+                model,
+                [{"mime_type": GEMINI_IMAGE_MIME, "data": img_bytes}],
+                generation_config=JSON_GENERATION_CONFIG,
+            )
+            response.resolve()
+
+            page_data = orjson.loads(response.text)
+
+            # --- NEW: Post-processing to validate and format dates ---
+            for key, value in page_data.items():
+                if key in DATE_FIELDS:
+                    page_data[key] = format_and_validate_date(value)
+
+            with _extraction_cache_lock:
+                _extraction_cache[cache_key] = dict(page_data)
+                _extraction_cache.move_to_end(cache_key)
+                while len(_extraction_cache) > EXTRACTION_CACHE_MAX_ENTRIES:
+                    _extraction_cache.popitem(last=False)
+            return page_data
+        except Exception as e:
+            logger.error(f"  > Gemini extraction failed for page {i+1}: {e}")
+            return schema # Return blank schema on failure
+
+    # Pages are independent and the Gemini calls are network-bound, so fan them
+    # out across a thread pool instead of awaiting each one in sequence.
+    # map() preserves page order. Worker count is capped to stay under RPM limits.
+    #
+    # JPEG encoding is CPU work that would otherwise run serially ahead of each
+    # network call, so it gets its own small pool: Pillow releases the GIL
+    # during save, and the encodes for later pages proceed while earlier pages'
+    # Gemini requests are in flight (double-buffering).
+    max_workers = min(int(os.getenv("GEMINI_PAGE_WORKERS", "8")), len(image_list))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as encode_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as gemini_pool:
+        encode_futures = [encode_pool.submit(encode_image_for_gemini, image) for image in image_list]
+        extracted_pages = list(gemini_pool.map(_process_page, enumerate(encode_futures)))
+
+    return extracted_pages
+
+BATCH_MODEL_NAME = EXTRACT_MODEL_NAME
+
+# Batch Mode lives in the newer google-genai SDK; the legacy
+# google.generativeai package used everywhere else has no batches surface.
+# The client is created lazily so the optional dependency is only required
+# when the async path is actually used.
+_batch_client = None
+_batch_client_lock = threading.Lock()
+
+
+def get_batch_client():
+    """Returns a lazily created google-genai Client for the Batch API."""
+    global _batch_client
+    with _batch_client_lock:
+        if _batch_client is None:
+            from google import genai as google_genai
+            _batch_client = google_genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+        return _batch_client
+
+
+def submit_batch_extraction(pending):
+    """
+    Submits all pages of the pending (filename, stream, doc_type) uploads as a
+    single Gemini Batch job and returns the remote batch name for polling.
+
+    Batch Mode runs at 50% of the synchronous token price and is scheduled
+    outside the per-minute request limits, which matters for large multi-page
+    uploads. Results arrive asynchronously via /extract-documents/<job_id>.
+    """
+    lines = []
+
+    for filename, stream, doc_type in pending:
+        if filename.lower().endswith('.pdf'):
+            images = convert_pdf_to_images(stream)
+        elif filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+            image = Image.open(stream)
+            image.load()  # Force the decode while the upload stream is open
+            images = [image]
+        else:
+            logger.warning(f"Skipping unsupported file: {filename}")
+            continue
+
+        prompt = EXTRACTION_PROMPTS[doc_type]
+        for i, image in enumerate(images):
+            img_bytes = encode_image_for_gemini(image)
+            # The key carries everything needed to reassemble the response,
+            # so polling needs no local job state.
+            key = f"{doc_type}|{filename}|{i}"
+            lines.append(orjson.dumps({
+                "key": key,
+                "request": {
+                    "contents": [{
+                        "parts": [
+                            {"text": prompt},
+                            {"inline_data": {
+                                "mime_type": GEMINI_IMAGE_MIME,
+                                "data": base64.b64encode(img_bytes).decode()
+                            }}
+                        ]
+                    }],
+                    "generation_config": {"response_mime_type": "application/json"}
+                }
+            }).decode())
+
+    if not lines:
+        raise ValueError("No supported files to submit for batch extraction.")
+
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.jsonl', delete=False) as f:
+        f.write("\n".join(lines))
+        jsonl_path = f.name
+
+    try:
+        client = get_batch_client()
+        src_file = client.files.upload(
+            file=jsonl_path, config={'mime_type': 'application/jsonl'}
+        )
+        batch_job = client.batches.create(model=BATCH_MODEL_NAME, src=src_file.name)
+    finally:
+        os.remove(jsonl_path)
+
+    logger.info(f"Submitted batch job {batch_job.name} with {len(lines)} page(s).")
+    return batch_job.name
+
+
+def collect_batch_results(batch_job):
+    """Downloads a finished batch job's JSONL output and rebuilds the
+    standard results dict keyed by doc_type.
+
+    Each result line's key encodes doc_type|filename|page index, so the
+    response shape can be reassembled on any worker without local job state."""
+    client = get_batch_client()
+    result_bytes = client.files.download(file=batch_job.dest.file_name)
+
+    per_file = {}  # (doc_type, filename) -> {page_idx: page_data}
+    for line in result_bytes.decode().splitlines():
+        if not line.strip():
+            continue
+        entry = orjson.loads(line)
+        key = entry.get("key", "")
+        doc_type, _, rest = key.partition('|')
+        filename, _, page_str = rest.rpartition('|')
+        if doc_type not in SCHEMAS or not page_str.isdigit():
+            logger.warning(f"Skipping batch result with unrecognized key: '{key}'")
+            continue
+        page_idx = int(page_str)
+        pages = per_file.setdefault((doc_type, filename), {})
+        try:
+            text = entry["response"]["candidates"][0]["content"]["parts"][0]["text"]
+            page_data = orjson.loads(text)
+            for k, v in page_data.items():
+                if k in DATE_FIELDS:
+                    page_data[k] = format_and_validate_date(v)
+            pages[page_idx] = page_data
+        except Exception as e:
+            logger.error(f"Failed to parse batch result for {key}: {e}")
+            pages[page_idx] = dict(SCHEMAS[doc_type])  # Blank schema placeholder
+
+    results = {"medical_report": [], "prescription": [], "medical_bill": []}
+    for (doc_type, filename), pages in per_file.items():
+        results[doc_type].append({
+            "filename": filename,
+            "pages": [pages[i] for i in sorted(pages)]
+        })
+    return results
+
+
+@app.route('/')
+def index():
+    return send_file('index_2.html')
+
+@app.route('/extract-documents', methods=['POST'])
+def extract_documents():
+    """
+    [MODIFIED] Stage 1: Extracts page-wise data and includes filenames in the response.
+    """
+    logger.info("Received request for document extraction.")
+    
+    results = {"medical_report": [], "prescription": [], "medical_bill": []}
+    doc_type_map = {
+        "medical_report_files": "medical_report",
+        "prescription_files": "prescription",
+        "medical_bill_files": "medical_bill"
+    }
+    
+    results_lock = threading.Lock()
+
+    def _process_file(filename, stream, doc_type):
+        images = []
+        if filename.lower().endswith('.pdf'):
+            images = convert_pdf_to_images(stream)
+        elif filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+            image = Image.open(stream)
+            image.load()  # Force the decode while the upload stream is open
+            images = [image]
+        else:
+            logger.warning(f"Skipping unsupported file: {filename}")
+            return
+
+        if images:
+            # This now returns a list of page data
+            page_wise_data = extract_data_with_gemini(images, doc_type)
+            # We package it with the filename
+            with results_lock:
+                results[doc_type].append({
+                    "filename": filename,
+                    "pages": page_wise_data
+                })
+
+    try:
+        # Hand each upload's spooled stream to exactly one worker instead of
+        # buffering whole files into memory: Werkzeug spools large uploads to
+        # disk, and pypdfium2/Pillow consume the streams directly. The request
+        # context (and thus the streams) stays alive while we wait on the
+        # futures below. Each file is independent (in-process rasterization +
+        # network-bound Gemini calls), so they overlap cleanly in a thread pool.
+        pending = []
+        for field_name, doc_type in doc_type_map.items():
+            uploaded_files = request.files.getlist(field_name)
+            if not uploaded_files: continue
+
+            logger.info(f"Processing {len(uploaded_files)} file(s) for type: {doc_type}")
+
+            for file in uploaded_files:
+                pending.append((file.filename, file.stream, doc_type))
+
+        # Batch Mode path: half-price tokens and no RPM ceiling, at the cost
+        # of asynchronous results. The client polls /extract-documents/<job_id>.
+        if request.args.get('async', '').lower() == 'true':
+            job_id = submit_batch_extraction(pending)
+            return jsonify({"job_id": job_id, "state": "PENDING"}), 202
+
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(_process_file, *args) for args in pending]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()  # Re-raise any worker exception here
+
+        return jsonify(results), 200
+        
+    except Exception as e:
+        logger.error(f"An error occurred during extraction: {e}", exc_info=True)
+        return jsonify({"error": "An internal error occurred during document extraction."}), 500
+
+@app.route('/extract-documents/<path:job_id>', methods=['GET'])
+def extract_documents_status(job_id):
+    """Polls a batch extraction job; returns results once it has succeeded.
+
+    job_id is the remote batch resource name (e.g. 'batches/abc123'), so any
+    gunicorn worker can serve the poll — no per-process job registry."""
+    try:
+        batch_job = get_batch_client().batches.get(name=job_id)
+        state = batch_job.state.name
+        if state != "JOB_STATE_SUCCEEDED":
+            return jsonify({"job_id": job_id, "state": state}), 200
+
+        results = collect_batch_results(batch_job)
+        return jsonify({"job_id": job_id, "state": state, "results": results}), 200
+    except Exception as e:
+        logger.error(f"An error occurred while polling batch job {job_id}: {e}", exc_info=True)
+        return jsonify({"error": "An internal error occurred while polling the batch job."}), 500
+
+
+def _deterministic_check(report_summary, prescription_summary, bill_summary):
+    """
+    Cheap rule-based pre-check run before the Gemini adjudication call.
+
+    Returns (should_skip, payload). Claims that are resolvable with plain
+    set/date operations — nothing extracted at all, or everything trivially
+    consistent — are answered here so the model only runs on genuinely
+    ambiguous claims. Anything uncertain returns (False, None) and falls
+    through to Gemini.
+    """
+    if not report_summary and not prescription_summary and not bill_summary:
+        return True, {
+            "claimValidation": {
+                "isPatientNameConsistent": False,
+                "isConsistent": False,
+                "isTreatmentBillMatch": False,
+                "isDateSequenceLogical": False
+            },
+            "finalAssessment": {
+                "isClaimValid": False,
+                "confidenceScore": 1.0,
+                "reasoning": [
+                    "No data could be extracted from any of the submitted documents.",
+                    "The clinical report, prescription, and billing summaries are all empty.",
+                    "A claim cannot be validated without any extracted document data."
+                ]
+            }
+        }
+
+    # Fast-pass: exact patient-name agreement across all documents that name
+    # one, strictly chronological report -> prescription -> bill dates, and
+    # every billed item mentioned verbatim in the clinical/prescription text.
+    # Values come from client-supplied JSON, so coerce via str() — a numeric
+    # or null field must fall through to the model, not crash the endpoint.
+    names = set()
+    for s in (report_summary, prescription_summary, bill_summary):
+        name = str(s.get("patient_name") or "").strip().lower()
+        if name:
+            names.add(name)
+    if len(names) != 1:
+        return False, None
+
+    try:
+        event_dates = [
+            datetime.strptime(str(report_summary["report_date"]), '%d/%m/%Y'),
+            datetime.strptime(str(prescription_summary["prescription_date"]), '%d/%m/%Y'),
+            datetime.strptime(str(bill_summary["bill_date"]), '%d/%m/%Y'),
+        ]
+    except (KeyError, ValueError, TypeError):
+        return False, None  # Missing or unparseable dates: let the model judge
+    if event_dates != sorted(event_dates):
+        return False, None  # Out of order: the model should cite the conflict
+
+    documented_text = " ".join(
+        str(v) for s in (report_summary, prescription_summary) for v in s.values()
+    ).lower()
+    bill_items = bill_summary.get("bill_items") or []
+    item_names = [str(item).strip().lower() for item in bill_items if str(item).strip()]
+    if not item_names or not all(name in documented_text for name in item_names):
+        return False, None
+
+    patient_name = names.pop()
+    return True, {
+        "claimValidation": {
+            "isPatientNameConsistent": True,
+            "isConsistent": True,
+            "isTreatmentBillMatch": True,
+            "isDateSequenceLogical": True
+        },
+        "finalAssessment": {
+            "isClaimValid": True,
+            "confidenceScore": 0.9,
+            "reasoning": [
+                f"The patient name '{patient_name}' matches exactly across the clinical report, prescription, and bill.",
+                f"Event dates are in logical order: report {report_summary['report_date']}, prescription {prescription_summary['prescription_date']}, bill {bill_summary['bill_date']}.",
+                "Every billed item appears verbatim in the clinical report or prescription data."
+            ]
+        }
+    }
+
+
+@app.route('/adjudicate-claim', methods=['POST'])
+def adjudicate_claim():
+    logger.info("Received request for claim adjudication.")
+    
+    extracted_data = request.get_json()
+    if not extracted_data:
+        return jsonify({"error": "No extracted data provided."}), 400
+
+    def summarize_category(category_data):
+        # Walk files and pages back to front so the first value seen wins,
+        # which preserves the old last-write-wins result in one pass while
+        # covering every file — the previous version only ever read
+        # category_data[0] and silently dropped the rest.
+        summary = {}
+        for file_entry in reversed(category_data or []):
+            for page in reversed(file_entry.get("pages", [])):
+                for key, value in page.items():
+                    if value and key not in summary:
+                        summary[key] = value
+        return summary
+
+    report_summary = summarize_category(extracted_data.get("medical_report", []))
+    prescription_summary = summarize_category(extracted_data.get("prescription", []))
+    bill_summary = summarize_category(extracted_data.get("medical_bill", []))
+
+    # Claims resolvable by simple rules skip the model call entirely.
+    should_skip, payload = _deterministic_check(report_summary, prescription_summary, bill_summary)
+    if should_skip:
+        logger.info("Claim adjudicated deterministically; skipping Gemini call.")
+        return jsonify(payload), 200
+
+
+    # Only the per-claim data goes in the user turn; the rules/schema block is
+    # a cached system instruction (see ADJUDICATION_INSTRUCTION).
+    claim_data_prompt = f"""
+    **Clinical Report Data:**
+    {orjson.dumps(report_summary, option=orjson.OPT_INDENT_2).decode()}
+
+    **Prescription Data:**
+    {orjson.dumps(prescription_summary, option=orjson.OPT_INDENT_2).decode()}
+
+    **Billing Data:**
+    {orjson.dumps(bill_summary, option=orjson.OPT_INDENT_2).decode()}
+    """
+
+    try:
+        model = get_cached_model("adjudicate", ADJUDICATE_MODEL_NAME, ADJUDICATION_INSTRUCTION)
+        response = generate_with_backoff(model, claim_data_prompt)
+        response.resolve()
+        
+        cleaned_text = FENCE_RE.sub('', response.text)
+        adjudication_result = orjson.loads(cleaned_text)
+        
+        logger.info("Successfully adjudicated claim.")
+        return jsonify(adjudication_result), 200
+        
+    except Exception as e:
+        logger.error(f"An error occurred during adjudication: {e}", exc_info=True)
+        return jsonify({"error": "An internal error occurred during claim adjudication."}), 500
+
+# --- MAIN EXECUTION ---
+if __name__ == '__main__':
+    # Development only: Werkzeug serves a single request at a time.
+    # Production runs through wsgi.py under gunicorn (see README).
+    app.run(debug=True, port=5001)
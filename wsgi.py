@@ -0,0 +1,19 @@
+"""
+WSGI entry point for running the app under a production server.
+
+Werkzeug's dev server handles one request at a time, which serializes all
+clients at the WSGI layer no matter how parallel the handlers are. Run this
+module under gunicorn with gevent workers so the Gemini network waits from
+concurrent requests overlap:
+
+    gunicorn -k gevent -w 4 -t 60 wsgi:app
+
+gevent monkey-patches Python socket I/O, which covers the Gemini calls
+because the app configures the REST transport (gRPC's C core bypasses
+Python sockets and would block the event loop). Gevent workers ignore
+--threads; use -w to scale.
+"""
+from app_ins import app
+
+if __name__ == "__main__":
+    app.run(port=5001)